@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+import random
+from typing import Any, Iterable
+
+import numpy as np
+
+Shape = tuple[int, ...]
+
+# Building big arrays with list_of_length(n, int_between(...)) costs a Python call per element,
+# for generating as well as for shrinking. Here we generate a whole array in one go, and shrink
+# it a region at a time. These helpers are shared by arrays_of in integrated.py and internal_shrink.py,
+# which import this module only when they're called, so numpy remains optional.
+
+def shrink_target(low: int, high: int) -> int:
+    # the same target as integrated's shrink_int
+    target = 0
+    if low > 0:
+        target = low
+    if high < 0:
+        target = high
+    return target
+
+
+def draw_array(rng: random.Random, dtype: Any, shape: Shape, low: int, high: int) -> np.ndarray:
+    # seeded from the runner's rng, so the array is reproducible from the test's seed.
+    numpy_rng = np.random.default_rng(rng.getrandbits(64))
+    return numpy_rng.integers(low, high, size=shape, dtype=dtype, endpoint=True)
+
+
+def is_valid_array(array: Any, dtype: Any, shape: Shape, low: int, high: int) -> bool:
+    return (
+        isinstance(array, np.ndarray)
+        and array.dtype == np.dtype(dtype)
+        and array.ndim == len(shape)
+        and all(length <= max_length for length, max_length in zip(array.shape, shape))
+        and (array.size == 0 or (array.min() >= low and array.max() <= high))
+    )
+
+
+def halve(distance: np.ndarray) -> np.ndarray:
+    # rounded towards zero, so it gets to zero for negative distances too. No abs, which
+    # would overflow for the smallest value of a signed dtype.
+    return (distance + (distance < 0)) // 2
+
+
+def shrink_array(array: np.ndarray, low: int, high: int) -> Iterable[np.ndarray]:
+    target = shrink_target(low, high)
+
+    # first make the array smaller, like shrink_list does, along each axis in turn.
+    for axis, length in enumerate(array.shape):
+        half_length = length // 2
+        if length > 0:
+            yield array[(slice(None),) * axis + (slice(0, 0),)]
+        while half_length != 0:
+            yield array[(slice(None),) * axis + (slice(0, half_length),)]
+            yield array[(slice(None),) * axis + (slice(half_length, length),)]
+            half_length = half_length // 2
+
+    # then the elements, a block at a time: first set a whole block to the target, then move it
+    # towards the target by half the distance, a quarter, and so on - like vintage_shrink's shrink_int,
+    # but for each element of the block at once.
+    # For big arrays we stop at blocks of about a thousandth of the array - trying every single element
+    # would be far too many candidates. Once the array is small enough, we do get to single elements.
+    flat = array.reshape(-1)
+    block_size = flat.size
+    min_block_size = max(1, flat.size // 1024)
+    while block_size >= min_block_size and block_size > 0:
+        for start in range(0, flat.size, block_size):
+            block = flat[start:start + block_size]
+            if not (block != target).any():
+                continue
+            smaller = flat.copy()
+            smaller[start:start + block_size] = target
+            yield smaller.reshape(array.shape)
+            step = halve(block - target)
+            while step.any():
+                smaller = flat.copy()
+                smaller[start:start + block_size] = block - step
+                yield smaller.reshape(array.shape)
+                step = halve(step)
+        block_size = block_size // 2
+
+
+@dataclass(frozen=True, eq=False)
+class ArrayChoice:
+    # a whole array as a single entry in internal_shrink's ChoiceSeq.
+    array: np.ndarray
+    low: int
+    high: int
+
+    def shrink(self) -> Iterable[ArrayChoice]:
+        for smaller in shrink_array(self.array, self.low, self.high):
+            yield ArrayChoice(smaller, self.low, self.high)
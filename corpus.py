@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+from typing import IO, Iterable, Iterator, Sequence
+
+from internal_shrink import ChoiceSeq, InvalidReplay, Property
+
+# A corpus is a file of ChoiceSeq histories, e.g. of all the failures we ever found,
+# that we replay to make sure they don't fail again. It can get big, so we don't read
+# it in: we mmap it, and only decode an entry when it's replayed.
+#
+# The layout is:
+#   MAGIC
+#   entries: number of choices, then the choices, all as varints
+#   index: the offset of each entry, as little-endian uint64
+#   footer: offset of the index and number of entries, as little-endian uint64
+#
+# Choices are zig-zag encoded, so small negative numbers stay small too.
+
+MAGIC = b"PBTCORP1"
+_OFFSET = struct.Struct("<Q")
+_FOOTER = struct.Struct("<QQ")
+
+
+class InvalidCorpus(Exception):
+    pass
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _zig_zag(value: int) -> int:
+    return -2*value - 1 if value < 0 else 2*value
+
+
+def _zag_zig(value: int) -> int:
+    return -(value + 1) // 2 if value & 1 else value // 2
+
+
+def encode_history(history: Sequence[int]) -> bytes:
+    out = bytearray()
+    _write_varint(out, len(history))
+    for choice in history:
+        if not isinstance(choice, int):
+            raise ValueError(f"Only int choices can be stored in a corpus, not {type(choice).__name__}.")
+        _write_varint(out, _zig_zag(choice))
+    return bytes(out)
+
+
+def write_corpus(file: IO[bytes], histories: Iterable[Sequence[int]]) -> int:
+    file.write(MAGIC)
+    offset = len(MAGIC)
+    offsets = bytearray()
+    for history in histories:
+        entry = encode_history(history)
+        offsets += _OFFSET.pack(offset)
+        file.write(entry)
+        offset += len(entry)
+    file.write(offsets)
+    count = len(offsets) // _OFFSET.size
+    file.write(_FOOTER.pack(offset, count))
+    return count
+
+
+class Corpus(Sequence[list[int]]):
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size < len(MAGIC) + _FOOTER.size:
+                raise InvalidCorpus(f"{path} is not a corpus.")
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise InvalidCorpus(f"{path} is not a corpus.")
+        self._index_offset, self._count = _FOOTER.unpack_from(self._mmap, len(self._mmap) - _FOOTER.size)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i):  # type: ignore[override]
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        (offset,) = _OFFSET.unpack_from(self._mmap, self._index_offset + i * _OFFSET.size)
+        return self._decode(offset)
+
+    def __iter__(self) -> Iterator[list[int]]:
+        return (self[i] for i in range(self._count))
+
+    def _decode(self, offset: int) -> list[int]:
+        data = self._mmap
+        values: list[int] = []
+        length = None
+        value, shift = 0, 0
+        while length is None or len(values) < length:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                if length is None:
+                    length = value
+                else:
+                    values.append(_zag_zig(value))
+                value, shift = 0, 0
+        return values
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def __enter__(self) -> Corpus:
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+
+def replay(property: Property, corpus: Iterable[list[int]]):
+    replayed, invalid = 0, 0
+    for entry_number, history in enumerate(corpus):
+        try:
+            result = property.generate(ChoiceSeq(history))
+        except InvalidReplay:
+            # the generators changed since the entry was written.
+            invalid += 1
+            continue
+        replayed += 1
+        if not result.is_success:
+            print(f"Fail: at corpus entry {entry_number} with arguments {result.arguments}.")
+            return
+    print(f"Success: {replayed} corpus entries passed, {invalid} no longer valid.")
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import dataclasses
+import itertools
+import json
+import pickle
+from typing import IO, Any, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# Generators are also useful to make up test data, e.g. for load tests. Every engine has
+# a stream function that lazily generates values; the writers here take such a stream,
+# and write it in chunks, so only one chunk is ever in memory. E.g.:
+#
+#   with open("persons.jsonl", "w") as f:
+#       write_jsonl(itertools.islice(vintage.stream(vintage.persons), 10_000_000), f)
+
+def chunked(values: Iterable[T], chunk_size: int) -> Iterator[list[T]]:
+    iterator = iter(values)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _to_json(value: Any) -> Any:
+    # only called for values json doesn't know about. Nested dataclasses come back here.
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {field.name: getattr(value, field.name) for field in dataclasses.fields(value)}
+    raise TypeError(f"Can't write {type(value).__name__} as json.")
+
+
+_encoder = json.JSONEncoder(default=_to_json, separators=(",", ":"))
+
+
+def write_jsonl(values: Iterable[Any], file: IO[str], chunk_size: int = 10_000) -> int:
+    written = 0
+    for chunk in chunked(values, chunk_size):
+        file.write("".join(_encoder.encode(value) + "\n" for value in chunk))
+        written += len(chunk)
+    return written
+
+
+# the binary format is just a sequence of pickled chunks - compact, fast, and
+# it can hold any value that can be pickled, not only the ones json can.
+def write_binary(values: Iterable[Any], file: IO[bytes], chunk_size: int = 10_000) -> int:
+    written = 0
+    for chunk in chunked(values, chunk_size):
+        pickle.dump(chunk, file, protocol=pickle.HIGHEST_PROTOCOL)
+        written += len(chunk)
+    return written
+
+
+def read_binary(file: IO[bytes]) -> Iterator[Any]:
+    while True:
+        try:
+            chunk = pickle.load(file)
+        except EOFError:
+            return
+        yield from chunk
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Iterator, Optional
+
+# sometimes it's easier to say what we don't want: such_that keeps generating until the predicate holds.
+# That silently gets very slow if the predicate rejects most values, so we keep track of how often
+# each such_that rejects during a test run, and fail loudly when it's too often. Shared by all the engines.
+
+class HealthCheckFailure(Exception):
+    pass
+
+@dataclass
+class Rejections:
+    accepted: int = 0
+    rejected: int = 0
+
+    def record(self, is_accepted: bool, max_rate: float = 0.9, min_tries: int = 100) -> None:
+        if is_accepted:
+            self.accepted += 1
+        else:
+            self.rejected += 1
+        tries = self.accepted + self.rejected
+        if tries >= min_tries and self.rejected > max_rate * tries:
+            raise HealthCheckFailure(f"such_that rejected {self.rejected} out of {tries} generated values.")
+
+
+class RunRejections:
+    # the rejections of each such_that, over all the test cases that one call to test generates.
+    # Shrinking isn't counted: it replays or re-generates values we already know about.
+    def __init__(self) -> None:
+        self._by_such_that: dict[Any, Rejections] = {}
+
+    def of(self, such_that: Any) -> Rejections:
+        return self._by_such_that.setdefault(such_that, Rejections())
+
+    @contextmanager
+    def counting(self) -> Iterator[None]:
+        token = current_run.set(self)
+        try:
+            yield
+        finally:
+            current_run.reset(token)
+
+
+# set by test while it generates test cases.
+current_run: ContextVar[Optional[RunRejections]] = ContextVar("current_run", default=None)
+
+
+def rejections_of(such_that: Any) -> Rejections:
+    # outside of a test run, e.g. in sample, each generated value is counted on its own.
+    run = current_run.get()
+    if run is None:
+        return Rejections()
+    return run.of(such_that)
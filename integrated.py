@@ -1,13 +1,16 @@
 
 from __future__ import annotations
+from collections import OrderedDict
 from copy import copy
 
 from dataclasses import dataclass, replace
 import itertools
 import random
-from typing import Any, Callable, Generic, Iterable, Protocol, TypeVar, Union
+from typing import Any, Callable, Generic, Iterable, Iterator, Optional, Protocol, TypeVar, Union
 
 from example import Person, is_valid, sort_by_age, wrong_sort_by_age
+from health import HealthCheckFailure, RunRejections, rejections_of
+from seen import SeenValues, cache_key, seen_values
 
 T = TypeVar("T")
 U = TypeVar("U")
@@ -27,29 +30,40 @@ V = TypeVar("V")
 #     return shrinker
 
 class Random(Generic[T]):
-    def __init__(self, generator: Callable[[], T]):
+    # the runner supplies the random.Random to draw from, so runs are reproducible from a seed.
+
+    # set by for_all and for_allN, so suite.py can tell properties apart from other generators.
+    is_property = False
+
+    def __init__(self, generator: Callable[[random.Random], T]):
         self._generator = generator
 
-    def generate(self) -> T:
-        return self._generator()
+    def generate(self, rng: random.Random) -> T:
+        return self._generator(rng)
 
-def random_sample(gen: Random[T]) -> list[T]:
-    return [gen.generate() for _ in range(10)]
+def random_sample(gen: Random[T], seed: Optional[int] = None) -> list[T]:
+    rng = random.Random(seed)
+    return [gen.generate(rng) for _ in range(10)]
+
+def random_stream(gen: Random[T], seed: Optional[int] = None) -> Iterator[T]:
+    rng = random.Random(seed)
+    while True:
+        yield gen.generate(rng)
 
 def random_constant(value:T) -> Random[T]:
-    return Random(lambda: value)
+    return Random(lambda _: value)
 
 def random_int_between(low: int, high: int) -> Random[int]:
-    return Random(lambda: random.randint(low, high))
+    return Random(lambda rng: rng.randint(low, high))
 
 def random_map(func: Callable[[T], U], gen: Random[T]) -> Random[U]:
-    return Random(lambda: func(gen.generate()))
+    return Random(lambda rng: func(gen.generate(rng)))
 
 def random_mapN(func: Callable[...,T], gens: Iterable[Random[Any]]) -> Random[T]:
-    return Random(lambda: func(gen.generate() for gen in gens))
+    return Random(lambda rng: func(gen.generate(rng) for gen in gens))
 
 def random_bind(func: Callable[[T], Random[U]], gen: Random[T]) -> Random[U]:
-    return Random(func(gen.generate()).generate)
+    return Random(lambda rng: func(gen.generate(rng)).generate(rng))
 
 
 class Shrink(Protocol[T]):
@@ -162,37 +176,98 @@ def tree_mapN(f: Callable[..., U], trees: Iterable[CandidateTree[Any]]) -> Candi
     )
 
 
+def memoize(f: Callable[[T], U], max_size: int) -> Callable[[T], U]:
+    # keeps the results for the max_size most recently used arguments.
+    cache: OrderedDict[Any, U] = OrderedDict()
+    def memoized(value: T) -> U:
+        key = cache_key(value)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        result = f(value)
+        cache[key] = result
+        if len(cache) > max_size:
+            cache.popitem(last=False)
+        return result
+    return memoized
+
+
 def tree_bind(
     f: Callable[[T], CandidateTree[U]],
-    tree: CandidateTree[T]
+    tree: CandidateTree[T],
+    cache_size: int = 256
 ) -> CandidateTree[U]:
 
-    # here we have a choice whether to shrink the T first, or U.
-    # Assuming we'd like to get as small as possible as soon as possible (reducing total nb of shrinks),
-    # and that a smaller T into property will result in a smaller U, we shrink T first.
-    tree_u = f(tree.value)
-    candidates = (
-        tree_bind(f, candidate)
-        for candidate in tree.candidates
-    )
+    # while walking the tree we often see the same T again. We then want the same U tree
+    # as before, instead of calling f again - in bind, f generates a new random U tree.
+    f = memoize(f, cache_size)
 
-    return CandidateTree(
-        value = tree_u.value,
-        candidates = itertools.chain(
-            candidates, 
-            tree_u.candidates
+    def do_bind(tree: CandidateTree[T]) -> CandidateTree[U]:
+        # here we have a choice whether to shrink the T first, or U.
+        # Assuming we'd like to get as small as possible as soon as possible (reducing total nb of shrinks),
+        # and that a smaller T into property will result in a smaller U, we shrink T first.
+        tree_u = f(tree.value)
+        candidates = (
+            do_bind(candidate)
+            for candidate in tree.candidates
         )
-    )
+
+        return CandidateTree(
+            value = tree_u.value,
+            candidates = itertools.chain(
+                candidates, 
+                tree_u.candidates
+            )
+        )
+
+    return do_bind(tree)
+
+
+def tree_unique(tree: CandidateTree[T]) -> CandidateTree[T]:
+    # tree_mapN and friends often reach the same value along different paths, e.g. by first shrinking
+    # the age and then the name of a Person, or the other way around. Each time we'd evaluate the property
+    # again, so here we leave out the candidates with values we've already seen while shrinking.
+    # Values from different trees are kept apart, because a value in one tree means something else
+    # than the same value in another.
+    tree_id = object()
+
+    def unique_candidates(tree: CandidateTree[T]) -> Iterable[CandidateTree[T]]:
+        seen = seen_values.get()
+        if seen is not None:
+            seen.add((tree_id, cache_key(tree.value)))
+        for candidate in tree.candidates:
+            if seen is None or seen.is_new((tree_id, cache_key(candidate.value))):
+                yield unique(candidate)
+
+    def unique(tree: CandidateTree[T]) -> CandidateTree[T]:
+        return CandidateTree(
+            value = tree.value,
+            candidates = unique_candidates(tree)
+        )
+
+    return unique(tree)
 
 
 Gen = Random[CandidateTree[T]]
 
+def stream(gen: Gen[T], seed: Optional[int] = None) -> Iterator[T]:
+    # we only need the values, so we never look at the candidates.
+    return (tree.value for tree in random_stream(gen, seed))
+
 def constant(value: T) -> Gen[T]:
     return random_constant(tree_constant(value))
 
 def int_between(low: int, high: int) -> Gen[int]:
     return random_map(lambda v: tree_from_shrink(v, shrink_int(low, high)), random_int_between(low, high))
 
+def arrays_of(dtype: Any, shape: tuple[int, ...], low: int, high: int) -> Gen[Any]:
+    # generates a whole numpy array in one go, and shrinks it a region at a time.
+    # Shrinking may make the array smaller than shape, along any axis.
+    from arrays import draw_array, shrink_array
+    return Random(lambda rng: tree_from_shrink(
+        draw_array(rng, dtype, shape, low, high),
+        lambda array: shrink_array(array, low, high)))
+
 def map(func: Callable[[T],U], gen: Gen[T]) -> Gen[U]:
     return random_map(lambda tree: tree_map(func, tree), gen)
 
@@ -212,18 +287,49 @@ def bind(func:Callable[[T], Gen[U]], gen: Gen[T]) -> Gen[U]:
     # because func returns a Random[SearchTree[U]] and search_tree_bind does not know how
     # to deal with Random.
     # We need to get a value out of Random, by generating it:
-    def inner_bind(value: T) -> CandidateTree[U]:
-        random_tree = func(value)
-        return random_tree.generate()
-    # this effectively means that while shrinking the outer value, we are randomly re-generating
-    # the inner value! Just like we did in vintage as well, in for_all.
-    return random_map(lambda tree: tree_bind(inner_bind, tree), gen)
+    def generator(rng: random.Random) -> CandidateTree[U]:
+        def inner_bind(value: T) -> CandidateTree[U]:
+            random_tree = func(value)
+            return random_tree.generate(rng)
+        # this effectively means that while shrinking the outer value, we are randomly re-generating
+        # the inner value! Just like we did in vintage as well, in for_all. At least tree_bind remembers
+        # the inner trees, so when we come back to an outer value we get the same inner value.
+        return tree_bind(inner_bind, gen.generate(rng))
+    return Random(generator)
+
+def unique(gen: Gen[T]) -> Gen[T]:
+    return random_map(tree_unique, gen)
 
 # now we can do things like generate a list of randomly chosen length
 def list_of(gen: Gen[T]) -> Gen[list[T]]:
     length = int_between(0, 10)
     return bind(lambda l: list_of_length(l, gen), length)
 
+def tree_filter(pred: Callable[[T], bool], tree: CandidateTree[T]) -> CandidateTree[T]:
+    candidates = (
+        tree_filter(pred, candidate)
+        for candidate in tree.candidates
+        if pred(candidate.value)
+    )
+    return CandidateTree(
+        value = tree.value,
+        candidates = candidates
+    )
+
+def such_that(pred: Callable[[T], bool], gen: Gen[T]) -> Gen[T]:
+    # while generating we retry until the predicate holds; while shrinking we
+    # just leave out the candidates that don't satisfy it.
+    key = object()
+    def generator(rng: random.Random) -> CandidateTree[T]:
+        rejections = rejections_of(key)
+        while True:
+            tree = gen.generate(rng)
+            is_accepted = pred(tree.value)
+            rejections.record(is_accepted)
+            if is_accepted:
+                return tree_filter(pred, tree)
+    return Random(generator)
+
 @dataclass(frozen=True)
 class TestResult:
     is_success: bool
@@ -238,9 +344,28 @@ def for_all(gen: Gen[T], property: Callable[[T], Union[Property,bool]]) -> Prope
             return constant(TestResult(is_success=outcome, arguments=(value,)))
         else:
             return map(lambda inner_out: replace(inner_out, arguments=(value,) + inner_out.arguments),outcome)
-    return bind(property_wrapper, gen)
-
-def test(property: Property):
+    result = bind(property_wrapper, unique(gen))
+    result.is_property = True
+    return result
+
+# unlike nested for_all, all arguments are generated up front and tree_mapN shrinks each of
+# them independently, without re-generating the others. Only a nested property is bound.
+def for_allN(gens: Iterable[Gen[Any]], property: Callable[..., Union[Property,bool]]) -> Property:
+    def property_wrapper(arguments: tuple[Any, ...]) -> Property:
+        outcome = property(*arguments)
+        if isinstance(outcome, bool):
+            return constant(TestResult(is_success=outcome, arguments=arguments))
+        if not isinstance(outcome, Random):
+            raise TypeError(f"property returned {outcome!r}, which is neither a bool nor a property")
+        return map(lambda inner_out: replace(inner_out, arguments=arguments + inner_out.arguments), outcome)
+    result = bind(property_wrapper, unique(mapN(tuple, gens)))
+    result.is_property = True
+    return result
+
+def new_seed() -> int:
+    return random.randrange(2**32)
+
+def test(property: Property, seed: Optional[int] = None) -> bool:
     def do_shrink(tree: CandidateTree[TestResult]) -> None:
         for smaller in tree.candidates:
             if not smaller.value.is_success:
@@ -252,19 +377,30 @@ def test(property: Property):
             print(f"Shrinking: gave up at arguments {tree.value.arguments}")
         
 
+    if seed is None:
+        seed = new_seed()
+    rejections = RunRejections()
     for test_number in range(100):
-        result = property.generate()
+        with rejections.counting():
+            result = property.generate(random.Random(seed + test_number))
         if not result.value.is_success:
-            print(f"Fail: at test {test_number} with arguments {result.value.arguments}.")
-            do_shrink(result)
-            return
-    print("Success: 100 tests passed.")
+            print(f"Fail: at test {test_number} with arguments {result.value.arguments} (seed={seed + test_number}).")
+            seen = SeenValues()
+            with seen.tracking():
+                do_shrink(result)
+            print(f"Shrinking: skipped {seen.skipped} candidates that were already tried.")
+            return False
+    print(f"Success: 100 tests passed (seed={seed}).")
+    return True
 
 
 wrong_sum = for_all(list_of(int_between(-10,10)), lambda l:
                 for_all(int_between(-10,10), lambda i: 
                     sum(e+i for e in l) == sum(l) + (len(l) +1) * i))
 
+wrong_sum_N = for_allN((list_of(int_between(-10,10)), int_between(-10,10)), lambda l, i:
+                sum(e+i for e in l) == sum(l) + (len(l) +1) * i)
+
 equality = for_all(int_between(-10,10), lambda l:
                 for_all(int_between(-10,10), lambda i: l == i))
 
@@ -274,6 +410,7 @@ letters = map(chr, int_between(ord('a'), ord('z')))
 simple_names = map("".join, list_of_length(6, letters))
 persons = mapN(lambda a: Person(*a), (simple_names, ages))
 lists_of_person = list_of(persons)
+adult_persons = such_that(lambda p: p.age >= 18, persons)
 
 prop_sort_by_age = for_all(
     lists_of_person, 
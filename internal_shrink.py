@@ -1,12 +1,16 @@
 from __future__ import annotations
 
+import os
+import pickle
 import random
-from dataclasses import dataclass, replace
+import time
+from dataclasses import dataclass, fields, is_dataclass, replace
 from decimal import InvalidOperation
-from typing import (Any, Callable, Generic, Iterable, Optional, Tuple, TypeVar,
-                    Union)
+from typing import (Any, Callable, Generator, Generic, Iterable, Iterator, Optional, Protocol, Tuple,
+                    TypeVar, Union, cast)
 
 from example import *
+from health import HealthCheckFailure, RunRejections, rejections_of
 
 T = TypeVar("T")
 U = TypeVar("U")
@@ -15,20 +19,63 @@ V = TypeVar("V")
 class InvalidReplay(Exception):
     pass
 
+class Rejected(InvalidReplay):
+    pass
+
+class BulkChoice(Protocol):
+    # many choices recorded as a single entry in the history, e.g. a whole numpy array.
+    # They know how to shrink themselves.
+    def shrink(self) -> Iterable[BulkChoice]:
+        ...
+
+Choice = Union[int, BulkChoice]
+
+# the values that sub-generators of map and mapN generated, by (generator, position of its
+# first choice), with the position after its last choice.
+Snapshots = dict[tuple["Random[Any]", int], tuple[int, Any]]
+
+IMMUTABLE_TYPES = (int, float, complex, bool, str, bytes, type(None))
+
+def is_immutable(value: Any) -> bool:
+    # a reused value is the same object every test run that reuses it gets. If a property
+    # changes it, e.g. sorts a list in place, later runs would get the changed value instead of
+    # what their choices say. So we only reuse values that can't be changed.
+    if type(value) in IMMUTABLE_TYPES:
+        return True
+    if type(value) in (tuple, frozenset):
+        return all(is_immutable(elem) for elem in value)
+    if is_dataclass(value) and type(value).__dataclass_params__.frozen:  # type: ignore[attr-defined]
+        return all(is_immutable(getattr(value, field.name)) for field in fields(value))
+    return False
+
 class ChoiceSeq:
-    def __init__(self, history: Optional[list[int]] = None) -> None:
+    # when recording, choices are drawn from the given rng, so a recording can be
+    # reproduced from its seed. When replaying, no rng is needed.
+    #
+    # A shrink candidate is the history of a failing test with one choice changed. Everything
+    # before that choice is the same, so a sub-generator that starts at the same position and
+    # only uses choices before the changed one will generate the same value again. reusable
+    # has the snapshots of the failing test, and unchanged is the position of the changed choice.
+    # Snapshots are only taken while replaying, so generating test cases doesn't pay for them.
+    def __init__(self, history: Optional[list[Choice]] = None, rng: Optional[random.Random] = None,
+                 reusable: Optional[Snapshots] = None, unchanged: int = 0) -> None:
         if history is None:
+            self._rng = rng if rng is not None else random.Random()
             self._replaying: Optional[int] = None
-            self.history: list[int] = []
+            self.history: list[Choice] = []
         else:
+            # replaying doesn't need an rng, and seeding one for every shrink candidate adds up.
             self._replaying = 0
             self.history = history
+        self.snapshots: Snapshots = {}
+        self._reusable = reusable if reusable is not None else {}
+        self._unchanged = unchanged
 
 
     def randint(self, low: int, high: int) -> int:
         if self._replaying is None:
             # recording
-            result = random.randint(low, high)
+            result = self._rng.randint(low, high)
             self.history.append(result)
             return result
         else:
@@ -37,44 +84,247 @@ class ChoiceSeq:
                 raise InvalidReplay()
             value = self.history[self._replaying]
             self._replaying += 1
-            if value < low or value > high:
+            if not isinstance(value, int) or value < low or value > high:
+                raise InvalidReplay()
+            return value
+
+    def bulk(self, draw: Callable[[random.Random], BulkChoice], is_valid: Callable[[BulkChoice], bool]) -> BulkChoice:
+        if self._replaying is None:
+            result = draw(self._rng)
+            self.history.append(result)
+            return result
+        else:
+            if self._replaying >= len(self.history):
+                raise InvalidReplay()
+            value = self.history[self._replaying]
+            self._replaying += 1
+            if isinstance(value, int) or not is_valid(value):
                 raise InvalidReplay()
             return value
 
+    def is_recording(self) -> bool:
+        return self._replaying is None
+
+    def position(self) -> int:
+        return len(self.history) if self._replaying is None else self._replaying
+
+    def snapshot(self, gen: Random[Any], start: int, value: Any) -> None:
+        if is_immutable(value):
+            self.snapshots[(gen, start)] = (self.position(), value)
+
+    def reuse(self, gen: Random[Any], start: int) -> Optional[tuple[Any]]:
+        # the value gen generated from start before, if it didn't use any changed choices.
+        snapshot = self._reusable.get((gen, start))
+        if snapshot is None or snapshot[0] > self._unchanged:
+            return None
+        self._replaying = snapshot[0]
+        self.snapshots[(gen, start)] = snapshot
+        return (snapshot[1],)
+
+    def reject(self, start: int) -> None:
+        if self._replaying is None:
+            # recording: forget the rejected choices, so that the history only
+            # contains choices that lead to accepted values.
+            del self.history[start:]
+        else:
+            # replaying: there's no point trying again, because the history only has
+            # the choices that were accepted while recording.
+            raise Rejected()
+
     def replay(self) -> None:
         self._replaying = 0
 
     def replayed_prefix(self) -> ChoiceSeq:
         if self._replaying is None:
             raise InvalidOperation()
-        return ChoiceSeq(self.history[:self._replaying])
+        prefix = ChoiceSeq(self.history[:self._replaying])
+        # snapshots of unchanged choices are still right, even if this replay didn't get to them.
+        kept = min(self._unchanged, self._replaying)
+        prefix.snapshots = {key: snapshot for key, snapshot in self._reusable.items() if snapshot[0] <= kept}
+        prefix.snapshots.update(self.snapshots)
+        return prefix
 
 
+# generators made out of other generators yield the generators they need values from,
+# and return their own value - see vintage.py.
+Steps = Callable[[ChoiceSeq], Generator["Random[Any]", Any, T]]
+
+# map and mapN of generators that don't need the stack call them directly, because that's a lot
+# faster - up to this depth of nested calls, see vintage.py.
+MAX_DIRECT_DEPTH = 50
+
 class Random(Generic[T]):
-    def __init__(self, generator: Callable[[ChoiceSeq], T]):
+    # set by for_all and for_allN, so suite.py can tell properties apart from other generators.
+    is_property = False
+
+    def __init__(self, generator: Optional[Callable[[ChoiceSeq], T]] = None, steps: Optional[Steps[T]] = None,
+                 depth: int = 0, choices: Optional[int] = None):
         self._generator = generator
+        self._steps = steps
+        self._depth = depth
+        # how many choices it always makes, if we know.
+        self._choices = choices
 
     def generate(self, choose: ChoiceSeq) -> T:
-        return self._generator(choose)
+        # an explicit stack instead of python recursion, so deeply nested generators
+        # don't hit the recursion limit.
+        if self._generator is not None:
+            return self._generator(choose)
+        waiting: list[Generator[Random[Any], Any, Any]] = [self._steps(choose)]  # type: ignore[misc]
+        value = None
+        while waiting:
+            steps = waiting[-1]
+            try:
+                gen = steps.send(value)
+                while gen._generator is not None:
+                    gen = steps.send(gen._generator(choose))
+            except StopIteration as stop:
+                waiting.pop()
+                value = stop.value
+                continue
+            waiting.append(gen._steps(choose))  # type: ignore[misc]
+            value = None
+        return value
 
-def sample(gen: Random[T]) -> list[tuple[T, list[int]]]:
-    choose = ChoiceSeq()
+def sample(gen: Random[T], seed: Optional[int] = None) -> list[tuple[T, list[Choice]]]:
+    choose = ChoiceSeq(rng=random.Random(seed))
     return [(gen.generate(choose),choose.history) for _ in range(10)]
 
+def stream(gen: Random[T], seed: Optional[int] = None) -> Iterator[T]:
+    # a fresh ChoiceSeq for each value, so the history doesn't keep growing.
+    rng = random.Random(seed)
+    while True:
+        yield gen.generate(ChoiceSeq(rng=rng))
+
 def constant(value:T) -> Random[T]:
-    return Random(lambda _: value)
+    return Random(lambda _: value, choices=0)
 
 def int_between(low: int, high: int) -> Random[int]:
-    return Random(lambda choose: choose.randint(low, high))
+    return Random(lambda choose: choose.randint(low, high), choices=1)
+
+def arrays_of(dtype: Any, shape: tuple[int, ...], low: int, high: int) -> Random[Any]:
+    # generates a whole numpy array in one go, recorded as a single entry in the history.
+    # Shrinking may make the array smaller than shape, along any axis.
+    from arrays import ArrayChoice, draw_array, is_valid_array
+
+    def draw(rng: random.Random) -> ArrayChoice:
+        return ArrayChoice(draw_array(rng, dtype, shape, low, high), low, high)
+
+    def is_valid(choice: BulkChoice) -> bool:
+        return isinstance(choice, ArrayChoice) and is_valid_array(choice.array, dtype, shape, low, high)
+
+    return Random(lambda choose: cast(ArrayChoice, choose.bulk(draw, is_valid)).array, choices=1)
+
+def direct_depth(gens: Iterable[Random[Any]]) -> Optional[int]:
+    depth = 0
+    for gen in gens:
+        if gen._generator is None:
+            return None
+        depth = max(depth, gen._depth + 1)
+    return depth if depth <= MAX_DIRECT_DEPTH else None
+
+def is_worth_reusing(gen: Random[Any]) -> bool:
+    # generators that make a single choice aren't: replaying them is as fast as looking them up.
+    # Neither are the ones we don't call directly or put on the stack, like int_between.
+    return gen._depth > 0 and (gen._choices is None or gen._choices > 1)
+
+def sub_generator(gen: Random[T]) -> Callable[[ChoiceSeq], T]:
+    # sub_result, for generators that map and mapN call directly.
+    generate: Callable[[ChoiceSeq], T] = gen._generator  # type: ignore[assignment]
+    if not is_worth_reusing(gen):
+        return generate
+    def reusing(choose: ChoiceSeq) -> T:
+        if choose.is_recording():
+            return generate(choose)
+        start = choose.position()
+        reused = choose.reuse(gen, start)
+        if reused is not None:
+            return reused[0]
+        value = generate(choose)
+        choose.snapshot(gen, start, value)
+        return value
+    return reusing
+
+def sub_result(choose: ChoiceSeq, gen: Random[T]) -> Generator[Random[Any], Any, T]:
+    # the value of gen, reused from before if we can - see ChoiceSeq.
+    if choose.is_recording() or (gen._generator is not None and not is_worth_reusing(gen)):
+        return (yield gen)
+    start = choose.position()
+    reused = choose.reuse(gen, start)
+    if reused is not None:
+        return reused[0]
+    value = yield gen
+    choose.snapshot(gen, start, value)
+    return value
 
 def map(func: Callable[[T], U], gen: Random[T]) -> Random[U]:
-    return Random(lambda choose: func(gen.generate(choose)))
+    depth = direct_depth((gen,))
+    if depth is not None:
+        generate = sub_generator(gen)
+        return Random(lambda choose: func(generate(choose)), depth=depth, choices=gen._choices)
+    def steps(choose: ChoiceSeq):
+        return func((yield from sub_result(choose, gen)))
+    return Random(steps=steps)
 
 def mapN(func: Callable[...,T], gens: Iterable[Random[Any]]) -> Random[T]:
-    return Random(lambda choose: func(*[gen.generate(choose) for gen in gens]))
+    gens = tuple(gens)
+    depth = direct_depth(gens)
+    if depth is not None:
+        generates = [sub_generator(gen) for gen in gens]
+        choices = None if any(gen._choices is None for gen in gens) else sum(gen._choices for gen in gens)  # type: ignore[misc]
+        return Random(lambda choose: func(*[generate(choose) for generate in generates]), depth=depth, choices=choices)
+    def steps(choose: ChoiceSeq):
+        values = []
+        for gen in gens:
+            values.append((yield from sub_result(choose, gen)))
+        return func(*values)
+    return Random(steps=steps)
 
 def bind(func: Callable[[T], Random[U]], gen: Random[T]) -> Random[U]:
-    return Random(lambda choose: func(gen.generate(choose)).generate(choose))
+    def steps(choose: ChoiceSeq):
+        return (yield func((yield gen)))
+    return Random(steps=steps)
+
+def such_that(pred: Callable[[T], bool], gen: Random[T]) -> Random[T]:
+    key = object()
+    def steps(choose: ChoiceSeq):
+        # only values we generate count - replaying while shrinking just repeats them.
+        rejections = rejections_of(key) if choose.is_recording() else None
+        while True:
+            start = choose.position()
+            value = yield gen
+            if pred(value):
+                if rejections is not None:
+                    rejections.record(True)
+                return value
+            choose.reject(start)
+            if rejections is not None:
+                rejections.record(False)
+    return Random(steps=steps)
+
+def choice(from_gens: Iterable[Random[Any]]) -> Random[Any]:
+    all = tuple(from_gens)
+    which_gen = int_between(0, len(all)-1)
+    return bind(lambda i: all[i], which_gen)
+
+def recursive(base: Random[T], extend: Callable[[Random[T]], Random[T]], max_depth: int,
+              max_size: int = 100) -> Random[T]:
+    # the depth is the first choice, so shrinking it makes values shallower. The size bounds
+    # the number of nodes, see vintage.py.
+    def sized(smaller: Random[T], size_left: list[int]) -> Random[T]:
+        def steps(choose: ChoiceSeq):
+            if size_left[0] <= 0:
+                return (yield base)
+            size_left[0] -= 1
+            return (yield smaller)
+        return Random(steps=steps)
+    def gen_at_depth(depth: int) -> Random[T]:
+        size_left = [max_size]
+        gen = base
+        for _ in range(depth):
+            gen = extend(sized(gen, size_left))
+        return gen
+    return bind(gen_at_depth, int_between(0, max_depth))
 
 def shrink_int(value: int) -> Iterable[int]:
     current = abs(value) - 1
@@ -99,22 +349,91 @@ def for_all(gen: Gen[T], property: Callable[[T], Union[Property,bool]]) -> Prope
             return constant(TestResult(is_success=outcome, arguments=(value,)))
         else:
             return map(lambda inner_out: replace(inner_out, arguments=(value,) + inner_out.arguments),outcome)
-    return bind(property_wrapper, gen)
+    result = bind(property_wrapper, gen)
+    result.is_property = True
+    return result
 
 def shrink_candidates(choices: ChoiceSeq) -> Iterable[ChoiceSeq]:
     # this is part of the list shrinker from vintage.py!
     for i,elem in enumerate(choices.history):
-        for smaller_elem in shrink_int(elem):
+        smaller_elems = shrink_int(elem) if isinstance(elem, int) else elem.shrink()
+        for smaller_elem in smaller_elems:
             smaller_history = list(choices.history)
             smaller_history[i] = smaller_elem
-            yield ChoiceSeq(smaller_history)
+            yield ChoiceSeq(smaller_history, reusable=choices.snapshots, unchanged=i)
+
 
+def for_allN(gens: Iterable[Gen[Any]], property: Callable[..., Union[Property,bool]]) -> Property:
+    gens = tuple(gens)
+    def steps(choose: ChoiceSeq):
+        values = []
+        for gen in gens:
+            values.append((yield from sub_result(choose, gen)))
+        arguments = tuple(values)
+        outcome = property(*arguments)
+        if isinstance(outcome, bool):
+            return TestResult(is_success=outcome, arguments=arguments)
+        if not isinstance(outcome, Random):
+            raise TypeError(f"property returned {outcome!r}, which is neither a bool nor a property")
+        inner_out = yield outcome
+        return replace(inner_out, arguments=arguments + inner_out.arguments)
+    result = Random(steps=steps)
+    result.is_property = True
+    return result
+
+def new_seed() -> int:
+    return random.randrange(2**32)
+
+# shrinking an expensive property can take a long time. To not lose that work when we're
+# interrupted, test can save the smallest failing choices so far to a checkpoint file,
+# and pick up from there next time it's called with the same file.
+def save_checkpoint(path: str, state: dict[str, Any]) -> None:
+    # write and rename, so we never leave half a checkpoint behind.
+    with open(path + ".tmp", "wb") as file:
+        pickle.dump(state, file)
+    os.replace(path + ".tmp", path)
+
+def load_checkpoint(path: str) -> Optional[dict[str, Any]]:
+    try:
+        with open(path, "rb") as file:
+            return pickle.load(file)
+    except FileNotFoundError:
+        return None
+
+def remove_checkpoint(path: Optional[str]) -> None:
+    # once we're done shrinking, or there's nothing to shrink anymore.
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+def test(property: Property, seed: Optional[int] = None, checkpoint: Optional[str] = None, checkpoint_every: float = 10.0) -> bool:
+    # choice prefixes that we know lead to a value rejected by such_that. Any candidate
+    # that starts with one of those will be rejected too, so we don't bother replaying it.
+    rejected_prefixes: set[tuple[int, ...]] = set()
+    rejected_lengths: set[int] = set()
+
+    def is_rejected(choices: ChoiceSeq) -> bool:
+        return any(tuple(choices.history[:length]) in rejected_prefixes for length in rejected_lengths)
+
+    last_checkpoint = time.monotonic()
+
+    def save(choices: ChoiceSeq, force: bool = False) -> None:
+        nonlocal last_checkpoint
+        if checkpoint is not None and (force or time.monotonic() - last_checkpoint >= checkpoint_every):
+            save_checkpoint(checkpoint, {"history": choices.history})
+            last_checkpoint = time.monotonic()
 
-def test(property: Property):
     def do_shrink(choices: ChoiceSeq) -> None:
+        save(choices)
         for smaller_choice in shrink_candidates(choices):
+            if is_rejected(smaller_choice):
+                continue
             try:
                 result = property.generate(smaller_choice)
+            except Rejected:
+                rejected_prefix = tuple(smaller_choice.replayed_prefix().history)
+                rejected_prefixes.add(rejected_prefix)
+                rejected_lengths.add(len(rejected_prefix))
+                continue
             except InvalidReplay:
                 # print(f"Shrinking: didn't work, invalid replay.")
                 continue
@@ -128,14 +447,42 @@ def test(property: Property):
             choices.replay()
             print(f"Shrinking: gave up at arguments {property.generate(choices).arguments}")
 
+    def shrink(choices: ChoiceSeq) -> None:
+        save(choices, force=True)
+        do_shrink(choices)
+        remove_checkpoint(checkpoint)
+
+    state = load_checkpoint(checkpoint) if checkpoint is not None else None
+    if state is not None:
+        choices = ChoiceSeq(state["history"])
+        try:
+            result = property.generate(choices)
+        except InvalidReplay:
+            result = None
+        if result is not None and not result.is_success:
+            print(f"Resuming: shrinking from checkpoint with arguments {result.arguments}.")
+            shrink(choices.replayed_prefix())
+            return False
+        print("Resuming: checkpoint doesn't fail anymore, starting over.")
+        remove_checkpoint(checkpoint)
+
+    if seed is None:
+        seed = new_seed()
+    rejections = RunRejections()
     for test_number in range(100):
-        choices = ChoiceSeq()
-        result = property.generate(choices)
+        choices = ChoiceSeq(rng=random.Random(seed + test_number))
+        with rejections.counting():
+            result = property.generate(choices)
         if not result.is_success:
-            print(f"Fail: at test {test_number} with arguments {result.arguments}.")
-            do_shrink(choices)
-            return
-    print(f"Success: 100 tests passed.")
+            print(f"Fail: at test {test_number} with arguments {result.arguments} (seed={seed + test_number}).")
+            # replay it once, for the snapshots that shrinking reuses.
+            choices.replay()
+            property.generate(choices)
+            shrink(choices)
+            return False
+    remove_checkpoint(checkpoint)
+    print(f"Success: 100 tests passed (seed={seed}).")
+    return True
 
 
 def list_of_gen(gens: Iterable[Gen[Any]]) -> Gen[list[Any]]:
@@ -154,6 +501,9 @@ wrong_sum = for_all(list_of(int_between(-10,10)), lambda l:
                 for_all(int_between(-10,10), lambda i: 
                     sum(e+i for e in l) == sum(l) + (len(l) +1) * i))
 
+wrong_sum_N = for_allN((list_of(int_between(-10,10)), int_between(-10,10)), lambda l, i:
+                sum(e+i for e in l) == sum(l) + (len(l) +1) * i)
+
 equality = for_all(int_between(-10,10), lambda l:
                 for_all(int_between(-10,10), lambda i: l == i))
 
@@ -162,6 +512,7 @@ letters = map(chr, int_between(ord('a'), ord('z')))
 simple_names = map("".join, list_of_length(6, letters))
 persons = mapN(Person, (simple_names, ages))
 lists_of_person = list_of(persons)
+adult_persons = such_that(lambda p: p.age >= 18, persons)
 
 prop_sort_by_age = for_all(
     lists_of_person, 
@@ -176,4 +527,13 @@ prop_wrong_sort_by_age = for_all(
 equality_letters = (
     for_all(letters, lambda l:
         for_all(letters, lambda i: l == i))
-)
\ No newline at end of file
+)
+
+# properties may change their arguments. Shrinking only reuses values that can't be changed,
+# so this still shrinks to ([1, 0], 4) - see is_immutable.
+def reverse_in_place(l: list[int], i: int) -> bool:
+    l.reverse()
+    return len(l) < 2 or l[0] <= l[1] or i < 4
+
+prop_reverse_in_place = for_all(map(lambda l: l, list_of(int_between(0, 10))), lambda l:
+                            for_all(int_between(0, 10), lambda i: reverse_in_place(l, i)))
@@ -1,9 +1,13 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, replace
+import os
+import pickle
 import random
-from typing import Any, Callable, Generic, Iterable, Optional, Tuple, TypeVar, Union
+import time
+from typing import Any, Callable, Generator, Generic, Iterable, Iterator, Optional, Tuple, TypeVar, Union
 from example import *
+from health import HealthCheckFailure, RunRejections, rejections_of
 
 T = TypeVar("T")
 U = TypeVar("U")
@@ -14,20 +18,70 @@ Size = int
 class SizeExceeded(Exception):
     pass
 
-class Random(Generic[T]):
-    def __init__(self, 
-        generator: Callable[[Optional[Size]], Tuple[T, Size]]):
-        self._generator = generator
+class Rejected(Exception):
+    pass
+
+# generators made out of other generators yield the generators they need values from, each with
+# the min_size to generate it with, and get back the value and its size - see vintage.py.
+Steps = Callable[[random.Random, Optional[Size]],
+                 Generator[Tuple["Random[Any]", Optional[Size]], Tuple[Any, Size], Tuple[T, Size]]]
 
-    def generate(self, min_size: Optional[Size] = None) -> Tuple[T, Size]:
-        return self._generator(min_size)
+# map and mapN of generators that don't need the stack call them directly, because that's a lot
+# faster - up to this depth of nested calls, see vintage.py.
+MAX_DIRECT_DEPTH = 50
 
+class Random(Generic[T]):
+    # the runner supplies the random.Random to draw from: a value is entirely determined
+    # by the seed of that rng, which is what makes seed-based shrinking reproducible.
 
-def sample(gen: Random[T]) -> list[T]:
-    return [gen.generate()[0] for _ in range(10)]
+    # set by for_all and for_allN, so suite.py can tell properties apart from other generators.
+    is_property = False
+
+    def __init__(self, 
+        generator: Optional[Callable[[random.Random, Optional[Size]], Tuple[T, Size]]] = None,
+        steps: Optional[Steps[T]] = None,
+        depth: int = 0,
+        smallest: Size = 0):
+        self._generator = generator
+        self._steps = steps
+        self._depth = depth
+        # the size of the smallest value it can generate. Generators made out of others leave
+        # at least this much of the budget for the ones that still have to generate a value.
+        self._smallest = smallest
+
+    def generate(self, rng: random.Random, min_size: Optional[Size] = None) -> Tuple[T, Size]:
+        # an explicit stack instead of python recursion, so deeply nested generators
+        # don't hit the recursion limit.
+        if self._generator is not None:
+            return self._generator(rng, min_size)
+        waiting: list[Generator[Any, Any, Any]] = [self._steps(rng, min_size)]  # type: ignore[misc]
+        value: Any = None
+        while waiting:
+            steps = waiting[-1]
+            try:
+                gen, gen_min_size = steps.send(value)
+                while gen._generator is not None:
+                    gen, gen_min_size = steps.send(gen._generator(rng, gen_min_size))
+            except StopIteration as stop:
+                waiting.pop()
+                value = stop.value
+                continue
+            waiting.append(gen._steps(rng, gen_min_size))
+            value = None
+        return value
+
+
+def sample(gen: Random[T], seed: Optional[int] = None) -> list[T]:
+    rng = random.Random(seed)
+    return [gen.generate(rng)[0] for _ in range(10)]
+
+def stream(gen: Random[T], seed: Optional[int] = None) -> Iterator[T]:
+    rng = random.Random(seed)
+    while True:
+        yield gen.generate(rng)[0]
 
 def constant(value:T) -> Random[T]:
-    return Random(lambda _: (value, 0))
+    return Random(lambda _, __: (value, 0))
 
 def dec_size(min_size: Optional[Size], decrease: Size) -> Optional[Size]:
     if min_size is None:
@@ -37,45 +91,113 @@ def dec_size(min_size: Optional[Size], decrease: Size) -> Optional[Size]:
         raise SizeExceeded(f"{min_size=} {decrease=} {smaller=}")
     return smaller
 
+def zig_zag(i: int) -> Size:
+    if i < 0:
+        return -2*i - 1
+    else:
+        return 2*i
+
+def budget_before(min_size: Optional[Size], smallest_after: Size) -> Optional[Size]:
+    # the budget for a generator, leaving enough for the smallest values of the ones after it.
+    return min_size if min_size is None else dec_size(min_size, smallest_after)
+
+def smallest_after(gens: Tuple[Random[Any], ...]) -> list[Size]:
+    return [sum(gen._smallest for gen in gens[i+1:]) for i in range(len(gens))]
+
 def int_between(low: int, high: int) -> Random[int]:
-    def zig_zag(i: int):
-        if i < 0:
-            return -2*i - 1
+    def generator(rng: random.Random, min_size: Optional[Size]):
+        if min_size is None:
+            value = rng.randint(low, high)
         else:
-            return 2*i
-    def generator(min_size: Optional[Size]):
-        value = random.randint(low, high)
+            # rather than drawing from [low, high] and throwing away values that are too big,
+            # only draw from the values whose zig-zag size fits in the remaining budget.
+            fit_low = max(low, -((min_size + 1) // 2))
+            fit_high = min(high, min_size // 2)
+            if fit_low > fit_high:
+                raise SizeExceeded(f"{min_size=} {low=} {high=}")
+            value = rng.randint(fit_low, fit_high)
         size = zig_zag(value)
         dec_size(min_size, size)
         return value, size
-    return Random(generator)
+    # the size of the value closest to 0.
+    smallest = 0 if low <= 0 <= high else min(zig_zag(low), zig_zag(high))
+    return Random(generator, smallest=smallest)
+
+def direct_depth(gens: Iterable[Random[Any]]) -> Optional[int]:
+    depth = 0
+    for gen in gens:
+        if gen._generator is None:
+            return None
+        depth = max(depth, gen._depth + 1)
+    return depth if depth <= MAX_DIRECT_DEPTH else None
 
 def map(func: Callable[[T], U], gen: Random[T]) -> Random[U]:
-    def generator(min_size: Optional[Size]):
-        result, size = gen.generate(min_size)
+    depth = direct_depth((gen,))
+    if depth is not None:
+        generate = gen._generator
+        def generator(rng: random.Random, min_size: Optional[Size]):
+            result, size = generate(rng, min_size)  # type: ignore[misc]
+            return func(result), size
+        return Random(generator, depth=depth, smallest=gen._smallest)
+    def steps(rng: random.Random, min_size: Optional[Size]):
+        result, size = yield gen, min_size
         return func(result), size
-    return Random(generator)
+    return Random(steps=steps, smallest=gen._smallest)
 
 def mapN(func: Callable[...,T], gens: Iterable[Random[Any]]) -> Random[T]:
-    def generator(min_size: Optional[Size]):
+    gens = tuple(gens)
+    afters = smallest_after(gens)
+    smallest = sum(gen._smallest for gen in gens)
+    depth = direct_depth(gens)
+    if depth is not None:
+        generates = [gen._generator for gen in gens]
+        def generator(rng: random.Random, min_size: Optional[Size]):
+            results: list[Any] = []
+            size_acc = 0
+            for generate, after in zip(generates, afters):
+                result, size = generate(rng, budget_before(min_size, after))  # type: ignore[misc]
+                min_size = dec_size(min_size, size)
+                results.append(result)
+                size_acc += size
+            return func(*results), size_acc
+        return Random(generator, depth=depth, smallest=smallest)
+    def steps(rng: random.Random, min_size: Optional[Size]):
         results: list[Any] = []
         size_acc = 0
-        for gen in gens:
-            result, size = gen.generate(min_size)
+        for gen, after in zip(gens, afters):
+            result, size = yield gen, budget_before(min_size, after)
             min_size = dec_size(min_size, size)
             results.append(result)
             size_acc += size
         return func(*results), size_acc
-    return Random(generator)
+    return Random(steps=steps, smallest=smallest)
 
 def bind(func: Callable[[T], Random[U]], gen: Random[T]) -> Random[U]:
-    def generator(min_size: Optional[Size]):
-        result,size_outer = gen.generate(min_size)
+    def steps(rng: random.Random, min_size: Optional[Size]):
+        result,size_outer = yield gen, min_size
         min_size = dec_size(min_size, size_outer)
-        result,size_inner = func(result).generate(min_size)
+        result,size_inner = yield func(result), min_size
         size = size_inner+size_outer
         return result, size
-    return Random(generator)
+    # we don't know the inner generator until we have the outer value, so there's nothing
+    # to leave room for - unless it's made by something like list_of, which knows more.
+    return Random(steps=steps, smallest=gen._smallest)
+
+def such_that(pred: Callable[[T], bool], gen: Random[T]) -> Random[T]:
+    key = object()
+    def steps(rng: random.Random, min_size: Optional[Size]):
+        rejections = rejections_of(key)
+        while True:
+            result, size = yield gen, min_size
+            if pred(result):
+                if min_size is None:
+                    rejections.record(True)
+                return result, size
+            if min_size is not None:
+                # while shrinking, we'd rather try a new seed than keep going with this one.
+                raise Rejected()
+            rejections.record(False)
+    return Random(steps=steps, smallest=gen._smallest)
 
 Gen = Random[T]
 
@@ -93,37 +215,135 @@ def for_all(gen: Gen[T], property: Callable[[T], Union[Property,bool]]) -> Prope
             return constant(TestResult(is_success=outcome, arguments=(value,)))
         else:
             return map(lambda inner_out: replace(inner_out, arguments=(value,) + inner_out.arguments),outcome)
-    return bind(property_wrapper, gen)
+    result = bind(property_wrapper, gen)
+    result.is_property = True
+    return result
+
+def for_allN(gens: Iterable[Gen[Any]], property: Callable[..., Union[Property,bool]]) -> Property:
+    gens = tuple(gens)
+    afters = smallest_after(gens)
+    def steps(rng: random.Random, min_size: Optional[Size]):
+        values: list[Any] = []
+        size_acc = 0
+        for gen, after in zip(gens, afters):
+            value, size = yield gen, budget_before(min_size, after)
+            min_size = dec_size(min_size, size)
+            values.append(value)
+            size_acc += size
+        arguments = tuple(values)
+        outcome = property(*arguments)
+        if isinstance(outcome, bool):
+            return TestResult(is_success=outcome, arguments=arguments), size_acc
+        if not isinstance(outcome, Random):
+            raise TypeError(f"property returned {outcome!r}, which is neither a bool nor a property")
+        inner_out, inner_size = yield outcome, min_size
+        return replace(inner_out, arguments=arguments + inner_out.arguments), size_acc + inner_size
+    result = Random(steps=steps)
+    result.is_property = True
+    return result
+
+def new_seed() -> int:
+    return random.randrange(2**32)
+
+# shrinking an expensive property can take a long time. To not lose that work when we're
+# interrupted, test can save where it's at to a checkpoint file every so often, and pick
+# up from there next time it's called with the same file.
+def save_checkpoint(path: str, state: dict[str, Any]) -> None:
+    # write and rename, so we never leave half a checkpoint behind.
+    with open(path + ".tmp", "wb") as file:
+        pickle.dump(state, file)
+    os.replace(path + ".tmp", path)
+
+def load_checkpoint(path: str) -> Optional[dict[str, Any]]:
+    try:
+        with open(path, "rb") as file:
+            return pickle.load(file)
+    except FileNotFoundError:
+        return None
 
-def test(property: Property):
-    def find_smaller(min_result: TestResult, min_size: Size):
-        skipped, not_shrunk, shrunk  = 0, 0, 0
+def remove_checkpoint(path: Optional[str]) -> None:
+    # once we're done shrinking, or there's nothing to shrink anymore.
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+def test(property: Property, seed: Optional[int] = None, size: Optional[Size] = None,
+         checkpoint: Optional[str] = None, checkpoint_every: float = 10.0) -> bool:
+    def find_smaller(min_result: TestResult, min_size: Size, min_seed: int, min_budget: Optional[Size],
+                     attempt_seeds: random.Random, skipped: int = 0, not_shrunk: int = 0, shrunk: int = 0):
+        # each attempt gets its own seed, and generates within a size budget that is just
+        # smaller than the smallest failing case so far. The smallest failing case can be
+        # reproduced by passing its seed and budget to test.
+        last_checkpoint = time.monotonic()
         while skipped + not_shrunk + shrunk <= 100_000 and min_size > 0:
+            if checkpoint is not None and time.monotonic() - last_checkpoint >= checkpoint_every:
+                save_checkpoint(checkpoint, {
+                    "min_seed": min_seed, "min_budget": min_budget,
+                    "attempt_seeds": attempt_seeds.getstate(),
+                    "skipped": skipped, "not_shrunk": not_shrunk, "shrunk": shrunk,
+                })
+                last_checkpoint = time.monotonic()
             try:
-                result, size = property.generate(min_size)
+                attempt_seed = attempt_seeds.randrange(2**32)
+                budget = min_size - 1
+                result, size = property.generate(random.Random(attempt_seed), budget)
                 if size >= min_size:
                     skipped += 1
                 elif not result.is_success:
                     shrunk += 1
-                    min_result, min_size = result, size
+                    min_result, min_size, min_seed, min_budget = result, size, attempt_seed, budget
                     # print(f"Shrinking: found smaller arguments {result.arguments}")
                 else:
                     not_shrunk += 1
                     # print(f"Shrinking: didn't work, smaller arguments {result.arguments} passed the test")
-            except SizeExceeded:
+            except (SizeExceeded, Rejected):
                 skipped += 1
 
-        print(f"Shrinking: gave up at arguments {min_result.arguments}")
+        print(f"Shrinking: gave up at arguments {min_result.arguments} (seed={min_seed}, size={min_budget})")
         print(f"{skipped=} {not_shrunk=} {shrunk=} {min_size=}")
-
-
+        remove_checkpoint(checkpoint)
+
+    state = load_checkpoint(checkpoint) if checkpoint is not None else None
+    if state is not None:
+        try:
+            result, result_size = property.generate(random.Random(state["min_seed"]), state["min_budget"])
+        except (SizeExceeded, Rejected):
+            result = None
+        if result is not None and not result.is_success:
+            print(f"Resuming: shrinking from checkpoint with arguments {result.arguments}.")
+            attempt_seeds = random.Random()
+            attempt_seeds.setstate(state["attempt_seeds"])
+            find_smaller(result, result_size, state["min_seed"], state["min_budget"], attempt_seeds,
+                         state["skipped"], state["not_shrunk"], state["shrunk"])
+            return False
+        print("Resuming: checkpoint doesn't fail anymore, starting over.")
+        remove_checkpoint(checkpoint)
+
+    if seed is None:
+        seed = new_seed()
+    rejections = RunRejections()
+    passed = 0
     for test_number in range(100):
-        result, size = property.generate()
+        try:
+            with rejections.counting():
+                result, result_size = property.generate(random.Random(seed + test_number), size)
+        except (SizeExceeded, Rejected):
+            # only when generating within a given size: that seed doesn't fit, or such_that
+            # rejected a value and there's no room to try again.
+            continue
         if not result.is_success:
-            print(f"Fail: at test {test_number} with arguments {result.arguments}.")
-            find_smaller(result, size)
-            return
-    print("Success: 100 tests passed.")
+            print(f"Fail: at test {test_number} with arguments {result.arguments} (seed={seed + test_number}).")
+            find_smaller(result, result_size, seed + test_number, size, random.Random(seed + test_number))
+            return False
+        passed += 1
+    remove_checkpoint(checkpoint)
+    if passed == 0:
+        # nothing was tested, so that's not a pass.
+        print(f"Gave up: none of the 100 tests fit in size {size} (seed={seed}).")
+    elif passed < 100:
+        print(f"Success: {passed} tests passed, {100 - passed} didn't fit in size {size} (seed={seed}).")
+    else:
+        print(f"Success: 100 tests passed (seed={seed}).")
+    return passed > 0
 
 
 # we don't even have to change the definition of letters!
@@ -137,13 +357,49 @@ def list_of_length(l: int, gen: Gen[T]) -> Gen[list[T]]:
     return gen_of_list
 
 def list_of(gen: Gen[T]) -> Gen[list[T]]:
-    length = int_between(0, 10)
-    return bind(lambda l: list_of_length(l, gen), length)
+    # like bind, but we know each element is at least as big as gen's smallest value. So we
+    # only draw lengths for which all the elements can still fit in the budget.
+    def steps(rng: random.Random, min_size: Optional[Size]):
+        max_length = 10
+        if min_size is not None:
+            max_length = min(max_length, min_size // (zig_zag(1) + gen._smallest))
+        length, length_size = yield int_between(0, max_length), min_size
+        min_size = dec_size(min_size, length_size)
+        result, size = yield list_of_length(length, gen), min_size
+        return result, length_size + size
+    return Random(steps=steps)
+
+def choice(from_gens: Iterable[Gen[Any]]) -> Gen[Any]:
+    all = tuple(from_gens)
+    which_gen = int_between(0, len(all)-1)
+    return bind(lambda i: all[i], which_gen)
+
+def recursive(base: Gen[T], extend: Callable[[Gen[T]], Gen[T]], max_depth: int,
+              max_size: int = 100) -> Gen[T]:
+    # the depth counts towards the size, so smaller values are also shallower. max_size bounds
+    # the number of nodes, see vintage.py - that's a different size than the one we shrink.
+    def sized(smaller: Gen[T], size_left: list[int]) -> Gen[T]:
+        def steps(rng: random.Random, min_size: Optional[Size]):
+            if size_left[0] <= 0:
+                return (yield base, min_size)
+            size_left[0] -= 1
+            return (yield smaller, min_size)
+        return Random(steps=steps, smallest=min(base._smallest, smaller._smallest))
+    def gen_at_depth(depth: int) -> Gen[T]:
+        size_left = [max_size]
+        gen = base
+        for _ in range(depth):
+            gen = extend(sized(gen, size_left))
+        return gen
+    return bind(gen_at_depth, int_between(0, max_depth))
 
 wrong_sum = for_all(list_of(int_between(-10,10)), lambda l:
                 for_all(int_between(-10,10), lambda i: 
                     sum(e+i for e in l) == sum(l) + (len(l) + 1) * i))
 
+wrong_sum_N = for_allN((list_of(int_between(-10,10)), int_between(-10,10)), lambda l, i:
+                sum(e+i for e in l) == sum(l) + (len(l) +1) * i)
+
 equality = for_all(int_between(-10,10), lambda l:
                 for_all(int_between(-10,10), lambda i: l == i))
 
@@ -157,6 +413,7 @@ letters = map(chr, int_between(ord('a'), ord('z')))
 simple_names = map("".join, list_of_length(6, letters))
 persons = mapN(Person, (simple_names, ages))
 lists_of_person = list_of(persons)
+adult_persons = such_that(lambda p: p.age >= 18, persons)
 
 prop_sort_by_age = for_all(
     lists_of_person, 
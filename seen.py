@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import hashlib
+import pickle
+from typing import Any, Iterator, Optional
+
+# while shrinking, the same value is often reached along different paths, e.g. by first shrinking
+# the age and then the name of a Person, or the other way around. integrated and vintage_shrink keep
+# track of the values they've tried, so the property isn't evaluated for them again. integrated also
+# uses cache_key to remember the inner tree of bind for each outer value.
+
+
+def cache_key(value: Any) -> Any:
+    # with the type, because 1, 1.0 and True are equal and hash the same, but they're different values.
+    # Lists and such aren't hashable, but they are the most common values to shrink.
+    try:
+        hash(value)
+        return (type(value), value)
+    except TypeError:
+        pass
+    try:
+        # exact and small, even for big values - repr abbreviates big numpy arrays.
+        return (type(value), hashlib.sha1(pickle.dumps(value)).digest())
+    except Exception:
+        return (type(value), repr(value))
+
+
+class SeenValues:
+    def __init__(self) -> None:
+        self._seen: set[Any] = set()
+        self.skipped = 0
+
+    def add(self, key: Any) -> None:
+        self._seen.add(key)
+
+    def is_new(self, key: Any) -> bool:
+        if key in self._seen:
+            self.skipped += 1
+            return False
+        self._seen.add(key)
+        return True
+
+    @contextmanager
+    def tracking(self) -> Iterator[None]:
+        token = seen_values.set(self)
+        try:
+            yield
+        finally:
+            seen_values.reset(token)
+
+
+# the values already tried in the current shrink, set by test while it is shrinking.
+seen_values: ContextVar[Optional[SeenValues]] = ContextVar("seen_values", default=None)
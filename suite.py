@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from dataclasses import dataclass
+import importlib
+import io
+import json
+import os
+import time
+import traceback
+from types import ModuleType
+from typing import Iterable, Optional
+
+# test runs one property at a time. A suite has many of them, spread over modules, so here
+# we find all the properties in some modules and run them on a pool of processes, e.g.:
+#
+#   run_suite(["integrated", "internal_shrink", "random_based"])
+#
+# Each property is run with its module's own test, and we keep how long it took in a
+# timings file. The next run starts the slowest properties first: if the slowest one is
+# started last, every other worker sits idle while it runs. Properties we haven't timed
+# yet go first, since for all we know they're the slow ones.
+
+
+@dataclass(frozen=True)
+class PropertyResult:
+    module: str
+    name: str
+    status: str  # "passed", "failed" or "error"
+    output: str
+    seconds: float
+
+
+def discover(module: ModuleType) -> list[str]:
+    # for_all and for_allN mark what they return as a property.
+    return [
+        name for name, value in vars(module).items()
+        if isinstance(value, module.Random) and value.is_property
+    ]
+
+
+def load_timings(path: str) -> dict[str, float]:
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_timings(path: str, timings: dict[str, float]) -> None:
+    with open(path + ".tmp", "w") as file:
+        json.dump(timings, file, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def schedule(keys: Iterable[str], timings: dict[str, float]) -> list[str]:
+    # longest processing time first. The pool hands out the properties in this order to
+    # whichever worker is free, so each one ends up on the least loaded worker.
+    return sorted(keys, key=lambda key: (key in timings, -timings.get(key, 0.0)))
+
+
+def run_property(module_name: str, name: str, seed: Optional[int]) -> PropertyResult:
+    # runs in a worker process, so we import the module there - before starting the clock, so
+    # that the first property of each module doesn't pay for the import. discover already imported
+    # it once, so it imports fine. test returns whether the property passed, and prints its report,
+    # which we capture to print it with the others at the end.
+    module = importlib.import_module(module_name)
+    output = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            is_success = module.test(getattr(module, name), seed=seed)
+        status = "passed" if is_success else "failed"
+    except Exception:
+        output.write(traceback.format_exc())
+        status = "error"
+    return PropertyResult(module_name, name, status, output.getvalue(), time.perf_counter() - start)
+
+
+def run_suite(module_names: Iterable[str], seed: Optional[int] = None, workers: Optional[int] = None,
+              timings_path: str = ".pbt_timings.json") -> list[PropertyResult]:
+    start = time.perf_counter()
+    properties = {
+        f"{module_name}.{name}": (module_name, name)
+        for module_name in module_names
+        for name in discover(importlib.import_module(module_name))
+    }
+    timings = load_timings(timings_path)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_property, *properties[key], seed) for key in schedule(properties, timings)]
+        results = [future.result() for future in futures]
+    for result in results:
+        timings[f"{result.module}.{result.name}"] = result.seconds
+    save_timings(timings_path, timings)
+
+    results.sort(key=lambda result: (result.module, result.name))
+    for result in results:
+        print(f"{result.status.upper()}: {result.module}.{result.name} ({result.seconds:.2f}s)")
+        if result.status != "passed":
+            for line in result.output.splitlines():
+                print(f"    {line}")
+    counts = {status: sum(result.status == status for result in results) for status in ("passed", "failed", "error")}
+    total = sum(result.seconds for result in results)
+    print(f"Suite: {counts['passed']} passed, {counts['failed']} failed, {counts['error']} errors "
+          f"in {time.perf_counter() - start:.2f}s ({total:.2f}s of testing).")
+    return results
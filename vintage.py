@@ -3,8 +3,10 @@ from __future__ import annotations
 from dataclasses import dataclass, replace
 import math
 import random
-from typing import Any, Callable, Generic, Iterable, Tuple, TypeVar, Union
+from typing import (Any, Callable, Generator, Generic, Iterable, Iterator, Optional, Tuple, TypeVar,
+                    Union)
 from example import *
+from health import HealthCheckFailure, RunRejections, rejections_of
 
 Value = TypeVar("Value", covariant=True)
 T = TypeVar("T")
@@ -12,33 +14,107 @@ U = TypeVar("U")
 V = TypeVar("V")
 
 
+# generators that are made out of other generators, like map and bind, are written as python
+# generator functions: they yield the generators whose values they need, get those values back,
+# and return their own value. See Random.generate for why.
+Steps = Callable[[random.Random], Generator["Random[Any]", Any, Value]]
+
+# going through Random.generate's stack is a lot slower than a direct python call though. So map
+# and mapN of generators that don't need the stack just call them directly. That nests python calls
+# only as deep as map and mapN are nested - unless something like recursive keeps nesting them, so
+# past this depth we use the stack after all.
+MAX_DIRECT_DEPTH = 50
+
 class Random(Generic[Value]):
-    def __init__(self, generate: Callable[[], Value]):
-        self._generate = generate
+    # generators draw from the random.Random they are given, never from the global random
+    # module - so a run is reproducible from its seed, and safe to run in several threads.
 
-    def generate(self) -> Value:
-        return self._generate()
+    # set by for_all and for_allN, so suite.py can tell properties apart from other generators.
+    is_property = False
 
-def sample(gen: Random[T]) -> list[T]:
-    return [gen.generate() for _ in range(5)]
+    def __init__(self, generate: Optional[Callable[[random.Random], Value]] = None, steps: Optional[Steps[Value]] = None,
+                 depth: int = 0):
+        self._generate = generate
+        self._steps = steps
+        # how deeply nested the python calls of generate are.
+        self._depth = depth
+
+    def generate(self, rng: random.Random) -> Value:
+        # if we'd just call the generators we need values from, deeply nested generators
+        # would need deeply nested python calls, and fail with a RecursionError. So we keep
+        # the generators that are waiting for a value on a stack of our own instead.
+        if self._generate is not None:
+            return self._generate(rng)
+        waiting: list[Generator[Random[Any], Any, Any]] = [self._steps(rng)]  # type: ignore[misc]
+        value = None
+        while waiting:
+            steps = waiting[-1]
+            try:
+                gen = steps.send(value)
+                # most generators that are yielded don't need any others, so we don't bother
+                # putting them on the stack.
+                while gen._generate is not None:
+                    gen = steps.send(gen._generate(rng))
+            except StopIteration as stop:
+                waiting.pop()
+                value = stop.value
+                continue
+            waiting.append(gen._steps(rng))  # type: ignore[misc]
+            value = None
+        return value
+
+def sample(gen: Random[T], seed: Optional[int] = None) -> list[T]:
+    rng = random.Random(seed)
+    return [gen.generate(rng) for _ in range(5)]
+
+def stream(gen: Random[T], seed: Optional[int] = None) -> Iterator[T]:
+    # like sample, but lazy and never-ending - use itertools.islice to take as many as you need.
+    rng = random.Random(seed)
+    while True:
+        yield gen.generate(rng)
 
 def constant(value:T) -> Random[T]:
-    return Random(lambda: value)
+    return Random(lambda _: value)
 
 pie = constant(math.pi)
 
 def int_between(low: int, high: int) -> Random[int]:
-    return Random(lambda: random.randint(low, high))
+    return Random(lambda rng: rng.randint(low, high))
 
 ages = int_between(0,100)
 
+def direct_depth(gens: Iterable[Random[Any]]) -> Optional[int]:
+    # the depth of a generator that calls all of gens directly, if it can.
+    depth = 0
+    for gen in gens:
+        if gen._generate is None:
+            return None
+        depth = max(depth, gen._depth + 1)
+    return depth if depth <= MAX_DIRECT_DEPTH else None
+
 def map(f: Callable[[T], U], gen: Random[T]) -> Random[U]:
-    return Random(lambda: f(gen.generate()))
+    depth = direct_depth((gen,))
+    if depth is not None:
+        generate = gen._generate
+        return Random(lambda rng: f(generate(rng)), depth=depth)  # type: ignore[misc]
+    def steps(rng: random.Random):
+        return f((yield gen))
+    return Random(steps=steps)
 
 letters = map(chr, int_between(ord('a'), ord('z')))
 
 def mapN(f: Callable[...,T], gens: Iterable[Random[Any]]) -> Random[T]:
-    return Random(lambda: f(*[gen.generate() for gen in gens]))
+    gens = tuple(gens)
+    depth = direct_depth(gens)
+    if depth is not None:
+        generates = [gen._generate for gen in gens]
+        return Random(lambda rng: f(*[generate(rng) for generate in generates]), depth=depth)  # type: ignore[misc]
+    def steps(rng: random.Random):
+        values = []
+        for gen in gens:
+            values.append((yield gen))
+        return f(*values)
+    return Random(steps=steps)
 
 # with mapN we gain some more power
 def list_of_length(l: int, gen: Random[T]) -> Random[list[T]]:
@@ -50,7 +126,7 @@ simple_names = map("".join, list_of_length(6, letters))
 persons = mapN(Person, (simple_names, ages))
 
 # with bind we gain yet more power - conventional wisdom says "anything is possible" with bind,
-# but there be dragons (e.g. tail recursion issues)
+# but there be dragons (e.g. tail recursion issues - which is why Random.generate keeps its own stack)
 # also: we can write map with bind but not the other way around 
 # also: it's like nested loops where the inner loop can depend on the value of the outer loop,
 # and we can keep nesting as many times as we want. With map and mapN we are "stuck" in the same 
@@ -60,10 +136,17 @@ def bind(f: Callable[[T], Random[U]], gen: Random[T]) -> Random[U]:
     # note the lambda and application is important here - we need to return a generator
     # that generates a new value every time it is called. If we'd just return f(gen()),
     # gen would only be called once, and so we'd only generate random Us for a single random T.
-    return Random(lambda: f(gen.generate()).generate())
+    def steps(rng: random.Random):
+        return (yield f((yield gen)))
+    return Random(steps=steps)
 
 def bindN(f: Callable[...,Random[T]], gens: Iterable[Random[Any]]) -> Random[T]:
-    return Random(lambda: f(*[gen.generate() for gen in gens]).generate())
+    def steps(rng: random.Random):
+        values = []
+        for gen in gens:
+            values.append((yield gen))
+        return (yield f(*values))
+    return Random(steps=steps)
 
 # now we can do things like generate a list of randomly chosen length
 def list_of(gen: Random[T]) -> Random[list[T]]:
@@ -72,11 +155,52 @@ def list_of(gen: Random[T]) -> Random[list[T]]:
 
 lists_of_person = list_of(persons)
 
+# recursive structures, like trees: extend makes a generator of bigger structures out of a generator of
+# smaller ones. We pick the depth up front, so values are never deeper than max_depth. Branching
+# is up to extend - e.g. use list_of or choice in there, so that not all branches go all the way down.
+# With branching, the number of nodes grows exponentially with the depth, so a value also has a size:
+# every smaller structure that extend asks for uses up one of max_size, which all of them share. Once
+# it's used up, the rest are base values. So a value has at most max_size nodes that aren't base
+# values, and at most as many base values as those nodes have children.
+def recursive(base: Random[T], extend: Callable[[Random[T]], Random[T]], max_depth: int,
+              max_size: int = 100) -> Random[T]:
+    def sized(smaller: Random[T], size_left: list[int]) -> Random[T]:
+        def steps(rng: random.Random):
+            if size_left[0] <= 0:
+                return (yield base)
+            size_left[0] -= 1
+            return (yield smaller)
+        return Random(steps=steps)
+    def gen_at_depth(depth: int) -> Random[T]:
+        # a fresh size for every value, so we make its generators every time - at most max_depth of them.
+        size_left = [max_size]
+        gen = base
+        for _ in range(depth):
+            gen = extend(sized(gen, size_left))
+        return gen
+    return bind(gen_at_depth, int_between(0, max_depth))
+
 def choice(from_gens: Iterable[Random[Any]]) -> Random[Any]:
     all = tuple(from_gens)
     which_gen = int_between(0, len(all)-1)
     return bind(lambda i: all[i], which_gen)
 
+# sometimes it's easier to say what we don't want: such_that keeps generating until the predicate holds.
+# See health.py for how we make sure that doesn't silently get very slow.
+def such_that(pred: Callable[[T], bool], gen: Random[T]) -> Random[T]:
+    key = object()
+    def steps(rng: random.Random):
+        rejections = rejections_of(key)
+        while True:
+            value = yield gen
+            is_accepted = pred(value)
+            rejections.record(is_accepted)
+            if is_accepted:
+                return value
+    return Random(steps=steps)
+
+adult_persons = such_that(lambda p: p.age >= 18, persons)
+
 # let's put this together and make a simple property-based testing library
 
 # we need a way for the user to give us a generator and a property, i.e. a function
@@ -105,8 +229,9 @@ sort_by_age_1 = for_all_1(lists_of_person, lambda persons_in: is_valid(persons_i
 wrong_sort_by_age_1 = for_all_1(lists_of_person, lambda persons_in: is_valid(persons_in, wrong_sort_by_age(persons_in)))
 
 def test_1(property: Property1):
+    rng = random.Random()
     for test_number in range(100):
-        if not property.generate():
+        if not property.generate(rng):
             print(f"Fail: at test {test_number}.")
             return
     print("Success: 100 tests passed.")
@@ -128,8 +253,20 @@ sum_of_list_2 = for_all_2(list_of(int_between(-10,10)), lambda l: for_all_2(int_
 # now we might think this would be better/more pythonic variant with variadic args - but this is slightly less
 # powerful - for_all is really like bind, while for_allN is like mapN. For example, with for_all you can generate
 # a random value and then make any of the inner generators depend on that value. 
-def for_allN(gens: Iterable[Random[Any]], property: Callable[..., Union[bool, Property1]]) -> Property1:
-    ...
+def for_allN_2(gens: Iterable[Random[Any]], property: Callable[..., Union[bool, Property1]]) -> Property1:
+    # no bind per argument: all arguments are generated in one go, as with mapN.
+    gens = tuple(gens)
+    def steps(rng: random.Random):
+        values = []
+        for gen in gens:
+            values.append((yield gen))
+        outcome = property(*values)
+        if isinstance(outcome, bool):
+            return outcome
+        return (yield outcome)
+    return Random(steps=steps)
+
+sum_of_list_N_2 = for_allN_2((list_of(int_between(-10,10)), int_between(-10,10)), lambda l, i: sum(e+i for e in l) == sum(l) + len(l) * i)
 
 # doesn't make a lot of sense but impossible to write with for_allN
 weird_sum_of_list = for_all_2(int_between(-10,10), lambda i: for_all_2(list_of(constant(i)), lambda l: sum(e+i for e in l) == sum(l) + len(l) * i))
@@ -153,21 +290,53 @@ def for_all(gen: Random[T], property: Callable[[T], Union[Property,bool]]) -> Pr
             return constant(TestResult(is_success=outcome, arguments=(value,)))
         else:
             return map(lambda inner_out: replace(inner_out, arguments=(value,) + inner_out.arguments),outcome)
-    return bind(property_wrapper, gen)
-
-def test(property: Property):
+    result = bind(property_wrapper, gen)
+    result.is_property = True
+    return result
+
+# and the variadic version - the arguments tuple is built once, instead of once per nesting level.
+def for_allN(gens: Iterable[Random[Any]], property: Callable[..., Union[Property,bool]]) -> Property:
+    gens = tuple(gens)
+    def steps(rng: random.Random):
+        values = []
+        for gen in gens:
+            values.append((yield gen))
+        arguments = tuple(values)
+        outcome = property(*arguments)
+        if isinstance(outcome, bool):
+            return TestResult(is_success=outcome, arguments=arguments)
+        inner_out = yield outcome
+        return replace(inner_out, arguments=arguments + inner_out.arguments)
+    result = Random(steps=steps)
+    result.is_property = True
+    return result
+
+def new_seed() -> int:
+    return random.randrange(2**32)
+
+# every test case gets its own seed, and test case i of a run with seed s uses seed s+i.
+# Passing the seed printed on failure reproduces the failing test case at test 0.
+# Returns whether all the tests passed, so that suite.py doesn't need to read what we print.
+def test(property: Property, seed: Optional[int] = None) -> bool:
+    if seed is None:
+        seed = new_seed()
+    rejections = RunRejections()
     for test_number in range(100):
-        result = property.generate()
+        with rejections.counting():
+            result = property.generate(random.Random(seed + test_number))
         if not result.is_success:
-            print(f"Fail: at test {test_number} with arguments {result.arguments}.")
-            return
-    print("Success: 100 tests passed.")
+            print(f"Fail: at test {test_number} with arguments {result.arguments} (seed={seed + test_number}).")
+            return False
+    print(f"Success: 100 tests passed (seed={seed}).")
+    return True
     
 wrong = for_all(list_of(letters), lambda l: list(reversed(l)) == l)
 rev_of_rev = for_all(list_of(letters), lambda l: list(reversed(list(reversed(l)))) == l)
 sum_of_list = for_all(list_of(int_between(-10,10)), lambda l: 
                 for_all(int_between(-10,10), lambda i: 
                     sum(e+i for e in l) == sum(l) + len(l) * i))
+sum_of_list_N = for_allN((list_of(int_between(-10,10)), int_between(-10,10)), lambda l, i:
+                sum(e+i for e in l) == sum(l) + len(l) * i)
 prop_sort_by_age = for_all(lists_of_person, lambda persons_in: is_valid(persons_in, sort_by_age(persons_in)))
 
 prop_wrong_sort_by_age = for_all(lists_of_person, lambda persons_in: is_valid(persons_in, wrong_sort_by_age(persons_in)))
@@ -1,10 +1,13 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Callable, Generic, Iterable, Protocol, TypeVar
+import random
+from typing import Any, Callable, Generic, Iterable, Optional, Protocol, Sequence, TypeVar
 
 from example import *
-from vintage import (Random, TestResult, int_between, list_of, lists_of_person, map)
+from health import RunRejections
+from seen import SeenValues, cache_key, seen_values
+from vintage import (Random, TestResult, int_between, list_of, lists_of_person, map, new_seed)
 
 
 T = TypeVar("T")
@@ -78,22 +81,69 @@ def tree_map(f: Callable[[T], U], tree: CandidateTree[T]) -> CandidateTree[U]:
     )
 
 
+def tree_unique(tree: CandidateTree[T]) -> CandidateTree[T]:
+    # shrink_list and friends often reach the same value along different paths, e.g. by first shrinking
+    # the age and then the name of a Person, or the other way around. Here we leave out the candidates
+    # we've already tried in this shrink, so the property isn't evaluated for them again.
+    def unique_candidates(tree: CandidateTree[T]) -> Iterable[CandidateTree[T]]:
+        seen = seen_values.get()
+        if seen is not None:
+            seen.add(cache_key(tree.value))
+        for candidate in tree.candidates:
+            if seen is None or seen.is_new(cache_key(candidate.value)):
+                yield unique(candidate)
+
+    def unique(tree: CandidateTree[T]) -> CandidateTree[T]:
+        return CandidateTree(
+            value = tree.value,
+            candidates = unique_candidates(tree)
+        )
+
+    return unique(tree)
+
+
 Property = Random[CandidateTree[TestResult]]
 
 
 def for_all(gen: Random[T], shrink: Shrink[T], property: Callable[[T], bool]) -> Property:
     def property_wrapper(value: T) -> CandidateTree[TestResult]:
-        search_tree_value = tree_from_shrink(value, shrink)
+        search_tree_value = tree_unique(tree_from_shrink(value, shrink))
         search_tree_test_result = tree_map(
             lambda v: TestResult(is_success=property(v), arguments=(v,)),
             search_tree_value
         )
         return search_tree_test_result
 
-    return map(property_wrapper, gen)
+    result = map(property_wrapper, gen)
+    result.is_property = True
+    return result
+
+
+def shrink_tuple(value: tuple[Any, ...], shrinks: Sequence[Shrink[Any]]) -> Iterable[tuple[Any, ...]]:
+    # each argument is shrunk independently, keeping the others fixed.
+    for i, (elem, shrink) in enumerate(zip(value, shrinks)):
+        for smaller_elem in shrink(elem):
+            yield value[:i] + (smaller_elem,) + value[i+1:]
+
 
+def for_allN(gens: Iterable[Random[Any]], shrinks: Iterable[Shrink[Any]], property: Callable[..., bool]) -> Property:
+    gens = tuple(gens)
+    shrinks = tuple(shrinks)
 
-def test(property: Property):
+    def generator(rng: random.Random) -> CandidateTree[TestResult]:
+        values = tuple(gen.generate(rng) for gen in gens)
+        search_tree_values = tree_unique(tree_from_shrink(values, lambda v: shrink_tuple(v, shrinks)))
+        return tree_map(
+            lambda v: TestResult(is_success=property(*v), arguments=v),
+            search_tree_values
+        )
+
+    result = Random(generator)
+    result.is_property = True
+    return result
+
+
+def test(property: Property, seed: Optional[int] = None) -> bool:
     def do_shrink(tree: CandidateTree[TestResult]) -> None:
         for smaller in tree.candidates:
             if not smaller.value.is_success:
@@ -104,13 +154,21 @@ def test(property: Property):
         print(f"Shrinking: gave up - smallest arguments found {tree.value.arguments}")
         
 
+    if seed is None:
+        seed = new_seed()
+    rejections = RunRejections()
     for test_number in range(100):
-        result = property.generate()
+        with rejections.counting():
+            result = property.generate(random.Random(seed + test_number))
         if not result.value.is_success:
-            print(f"Fail: at test {test_number} with arguments {result.value.arguments}.")
-            do_shrink(result)
-            return
-    print("Success: 100 tests passed.")
+            print(f"Fail: at test {test_number} with arguments {result.value.arguments} (seed={seed + test_number}).")
+            seen = SeenValues()
+            with seen.tracking():
+                do_shrink(result)
+            print(f"Shrinking: skipped {seen.skipped} candidates that were already tried.")
+            return False
+    print(f"Success: 100 tests passed (seed={seed}).")
+    return True
 
 
 wrong_shrink_1 = for_all(
@@ -147,3 +205,10 @@ def shrink_list_of_person(value: list[Person]) -> Iterable[list[Person]]:
 prop_wrong_sort_by_age = for_all(
     lists_of_person, shrink_list_of_person,
     lambda persons_in: is_valid(persons_in, wrong_sort_by_age(persons_in)))
+
+
+wrong_sum = for_allN(
+    (list_of(int_between(-10, 10)), int_between(-10, 10)),
+    (lambda value: shrink_list(value, shrink_int), shrink_int),
+    lambda l, i: sum(e+i for e in l) == sum(l) + (len(l) + 1) * i
+)